@@ -1,10 +1,15 @@
 # Library
 
 from sympy import symbols, zeros, simplify, cancel, ratsimp,\
-                    exp, log, diff, sqrt
+                    exp, log, diff, sqrt, count_ops, N, nan, Matrix
 from numpy import array, copy
 from copy import deepcopy
 import time
+import gc
+import os
+import pickle
+import resource
+import tempfile
 
 #######################################
 # Helper functions
@@ -87,6 +92,179 @@ def isConsistent(model,chords):
     return(True)
 
     
+#######################################
+# Budgets for the symbolic calculation
+#######################################
+
+### A large intermediate that has been written to disk
+class Spilled:
+    def __init__(self, path):
+        self.path = path
+
+### Current resident memory in bytes, None if it cannot be determined.
+### ru_maxrss is a peak value and thus not usable for a budget.
+def getMemory():
+    try:
+        with open('/proc/self/statm') as statm:
+            return(int(statm.read().split()[1])*os.sysconf('SC_PAGE_SIZE'))
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return(None)
+    return(psutil.Process().memory_info().rss)
+
+# A budget bounds the symbolic calculation of getCumulants and friends.
+# Without any limits, it does not change the calculation at all.
+#
+# 'maxOps' is the maximal expression size (as given by count_ops) that is
+#        passed to a simplification
+# 'maxMemory' is the resident memory (in bytes) above which no further
+#        simplification is started; needs /proc or psutil
+# 'hardMemory' optionally limits the address space (in bytes) during the
+#        calculation; a step that runs out of it is abandoned
+# 'spillOps' is the expression size above which finished covariance entries
+#        are written to disk until all of them are done
+# 'spillDir' is the directory for these files (default: system temp dir)
+# 'fallback' is applied to an entry whenever a limit is hit:
+#        'unsimplified' keeps the entry as is, 'numeric' turns its
+#        coefficients into floats, as done before lambdification.
+#        An entry that cannot be calculated at all becomes nan.
+# 'graceful' turns a MemoryError into the fallback or nan, as described
+#        above; without a budget, getCumulants and friends raise instead
+#
+# 'maxOps' and 'maxMemory' are either a single value or a dictionary with
+# a value per phase: 'characteristic polynomial', 'current vector',
+# 'simplifying current vector', 'covariance matrix',
+# 'simplifying expectation' and 'simplifying covariance matrix'.
+# Phases missing from the dictionary are not limited.
+
+class Budget:
+
+    def __init__(self, maxOps=None, maxMemory=None, hardMemory=None,
+                 spillOps=None, spillDir=None, fallback='unsimplified',
+                 graceful=True):
+        if( fallback not in ('unsimplified', 'numeric') ):
+            raise ValueError("Unknown fallback %s" % fallback)
+        self.maxOps = maxOps
+        self.maxMemory = maxMemory
+        self.hardMemory = hardMemory
+        self.spillOps = spillOps
+        self.spillDir = spillDir
+        self.fallback = fallback
+        self.graceful = graceful
+        self.current = None
+        self.degraded = [] # phases in which a limit was hit
+        self.spilled = set() # paths of spilled intermediates
+        self.oldLimit = None
+
+    ### Limit of the current phase
+    def limit(self, value):
+        if( isinstance(value, dict) ):
+            return(value.get(self.current))
+        return(value)
+
+    ### Limit the address space for the duration of the calculation
+    def __enter__(self):
+        self.current = None
+        self.degraded = []
+        if( self.maxMemory is not None and getMemory() is None ):
+            print(" WARNING:  Memory in use is unknown, ignoring maxMemory.")
+        if( self.hardMemory is not None ):
+            self.oldLimit = resource.getrlimit(resource.RLIMIT_AS)
+            resource.setrlimit(resource.RLIMIT_AS, (self.hardMemory, self.oldLimit[1]))
+        return(self)
+
+    ### Restore the limit and remove spilled intermediates, also on errors
+    def __exit__(self, *exc):
+        try:
+            for path in self.spilled:
+                if( os.path.exists(path) ):
+                    os.remove(path)
+            self.spilled = set()
+        finally:
+            if( self.oldLimit is not None ):
+                resource.setrlimit(resource.RLIMIT_AS, self.oldLimit)
+                self.oldLimit = None
+        return(False)
+
+    ### Start a new phase of the calculation, after freeing intermediates
+    def phase(self, name):
+        self.current = name
+        if( self.maxMemory is not None or self.hardMemory is not None ):
+            gc.collect()
+            memory = getMemory()
+            if( memory is not None ):
+                print("Memory in use: %.1f MB" % (memory/2**20))
+
+    def warn(self, reason, keeping):
+        if( self.current not in self.degraded ):
+            print(" WARNING:  %s in phase '%s', keeping %s entries." \
+                        % (reason, self.current, keeping))
+            self.degraded.append(self.current)
+
+    def degrade(self, expr, reason):
+        self.warn(reason, self.fallback)
+        if( self.fallback == 'numeric' ):
+            return(self.guard(N, expr))
+        return(expr)
+
+    ### Run a step that cannot be skipped, an entry it cannot calculate becomes nan
+    def guard(self, func, *args):
+        try:
+            return(func(*args))
+        except MemoryError:
+            if( not self.graceful ):
+                raise
+            gc.collect()
+            self.warn("Out of memory", "nan")
+            return(nan)
+
+    ### Substitute guarded, one substitution list after the other
+    def subs(self, expr, *substitutions):
+        def substitute():
+            result = expr
+            for substitution in substitutions:
+                result = result.subs(substitution)
+            return(result)
+        return(self.guard(substitute))
+
+    ### Apply a simplification 'func' to 'expr' within the budget
+    def apply(self, func, expr):
+        maxOps = self.limit(self.maxOps)
+        maxMemory = self.limit(self.maxMemory)
+        if( maxOps is not None and count_ops(expr) > maxOps ):
+            return(self.degrade(expr, "Expression size budget exceeded"))
+        if( maxMemory is not None and (getMemory() or 0) > maxMemory ):
+            return(self.degrade(expr, "Memory budget exceeded"))
+        try:
+            return(func(expr))
+        except MemoryError:
+            if( not self.graceful ):
+                raise
+            gc.collect()
+            return(self.degrade(expr, "Out of memory"))
+
+    ### Write a large expression to disk, return a handle for 'load'
+    def spill(self, expr):
+        if( self.spillOps is None or count_ops(expr) <= self.spillOps ):
+            return(expr)
+        fd, path = tempfile.mkstemp(suffix='.pickle', dir=self.spillDir)
+        self.spilled.add(path)
+        with os.fdopen(fd, 'wb') as spillfile:
+            pickle.dump(expr, spillfile)
+        return(Spilled(path))
+
+    def load(self, handle):
+        if( not isinstance(handle, Spilled) ):
+            return(handle)
+        with open(handle.path, 'rb') as spillfile:
+            expr = pickle.load(spillfile)
+        os.remove(handle.path)
+        self.spilled.discard(handle.path)
+        return(expr)
+
 #######################################
 # Cumulants possibly with simplifications
 #######################################
@@ -97,10 +275,10 @@ def isConsistent(model,chords):
 # 'param' is an optional substitution list for the parametrization of the model
 # 'simp' is an optional substitution list for simplifications
 # 'unsimp' should revert 'simp': expression.sub(simp).sub(unsimp) == expression
+# 'budget' is an optional Budget that bounds expression sizes and memory
 
-def getCumulants(model, chords, param=[], simp=[], unsimp=[]):
+def getCumulants(model, chords, param=[], simp=[], unsimp=[], budget=None):
 
-    doSimplify=not(simp==[] and unsimp == [])
     start_time = time.time()
 
     if( not isConsistent(model,chords) ):
@@ -133,10 +311,62 @@ def getCumulants(model, chords, param=[], simp=[], unsimp=[]):
         
     #display(Wq)
     
+    return( getTiltedCumulants(Wq, q, param, simp, unsimp, start_time, budget) )
+
+
+#######################################
+# Cumulants from a tilted generator
+#######################################
+
+# 'Wq' is a tilted generator, depending on the counting fields in 'q'
+# 'q' is a column vector of the counting fields (symbols)
+# 'param', 'simp', 'unsimp' and 'budget' are as for getCumulants
+# 'start_time' is an optional reference time for the progress output
+
+def getTiltedCumulants(Wq, q, param=[], simp=[], unsimp=[], start_time=None, budget=None):
+
+    if( budget is None ):
+        budget = Budget(graceful=False) # no limits, no degradation
+    with budget:
+        try:
+            return( boundedTiltedCumulants(Wq, q, param, simp, unsimp, start_time, budget) )
+        except MemoryError:
+            if( not budget.graceful ):
+                raise
+            ### out of memory outside of a guarded step, intermediates are gone now
+            gc.collect()
+            budget.warn("Out of memory", "nan")
+            B = len(q)
+            return( [Matrix(B, 1, lambda i,j: nan), Matrix(B, B, lambda i,j: nan)] )
+
+### simplify() on a tuple, as used for the coefficients of the characteristic
+### polynomial, only does signsimp and simplifies inside function arguments.
+### Coefficient-wise, this gives the same result as for the whole tuple.
+def coefficientSimplify(coeff):
+    return(simplify((coeff,))[0])
+
+def boundedTiltedCumulants(Wq, q, param, simp, unsimp, start_time, budget):
+
+    doSimplify=not(simp==[] and unsimp == [])
+    if( start_time is None ):
+        start_time = time.time()
+
+    ### number of counting fields
+    B = len(q)
+
     ### Find coefficients of characteristic polynomial
     print("--- %s seconds ---" % (time.time() - start_time))
     print("Start calculating characteristic polynomial")
-    a = simplify(Wq.berkowitz()[-1][::-1])  # symbolic simplification is *crucial* here!
+    budget.phase("characteristic polynomial")
+    a = budget.guard(Wq.berkowitz)
+    if( a is nan ):
+        a = [nan]*3
+    else:
+        a = list(a[-1][::-1])
+    ### only the three lowest coefficients enter the first two cumulants,
+    ### a single-state unit cell has no a[2]
+    a = a[:3] + [0]*(3-len(a))
+    a = [budget.apply(coefficientSimplify, coeff) for coeff in a]  # symbolic simplification is *crucial* here!
         
     ### Initialize current vector and covariance matrix
     c = zeros(B,1)
@@ -145,62 +375,74 @@ def getCumulants(model, chords, param=[], simp=[], unsimp=[]):
     ### Calculate current vector
     print("--- %s seconds ---" % (time.time() - start_time))
     print("Start calculating current vector")
+    budget.phase("current vector")
     for i in range(B):
-        c[i] = -(diff(a[0],q[i])/a[1]).ratsimp() ## populate current vector
+        c[i] = -budget.apply(ratsimp, budget.guard(lambda: diff(a[0],q[i])/a[1])) ## populate current vector
         
-    for i in range(B):
-        c=c.subs(q[i],0) ## subsitute q=0
+    c = c.applyfunc(lambda e: budget.subs(e, [(q[i],0) for i in range(B)])) ## subsitute q=0
     
     if(doSimplify):
-        c = c.subs(param)
+        c = c.applyfunc(lambda e: budget.subs(e, param))
         
         print("--- %s seconds ---" % (time.time() - start_time))
         print("Start simplifying current vector")
-        c = simplify(c.subs(simp)) #simplify cancel
+        budget.phase("simplifying current vector")
+        c = c.applyfunc(lambda e: budget.apply(simplify, budget.subs(e, simp))) #simplify cancel
     
     ### Calculate co-variance matrix
     print("--- %s seconds ---" % (time.time() - start_time))
     print("Start calculating covariance matrix")
+    budget.phase("covariance matrix")
+
+    ### finished entries, possibly spilled to disk
+    entries = {}
     
     ### Do in-place parametrization, before simplification, if latter is demanded
     if(doSimplify):
         for i in range(B):
             for j in range(i+1):
-                t1 = ratsimp(  diff(a[0],q[i],q[j]).subs(param).subs(simp) )
-                t2 = ratsimp( (diff(a[1],q[i])*c[j]).subs(param).subs(simp) )
-                t3 = ratsimp( (diff(a[1],q[j])*c[i]).subs(param).subs(simp) )
-                t4 = ratsimp( (2*a[2]*c[i]*c[j]).subs(param).subs(simp) )
-                t5 = ratsimp( a[1].subs(param).subs(simp) )
-                C[i,j] = -(t1 + t2 + t3 + t4)/t5
+                t1 = budget.apply(ratsimp, budget.subs(  diff(a[0],q[i],q[j]), param, simp) )
+                t2 = budget.apply(ratsimp, budget.subs( (diff(a[1],q[i])*c[j]), param, simp) )
+                t3 = budget.apply(ratsimp, budget.subs( (diff(a[1],q[j])*c[i]), param, simp) )
+                t4 = budget.apply(ratsimp, budget.subs( (2*a[2]*c[i]*c[j]), param, simp) )
+                t5 = budget.apply(ratsimp, budget.subs( a[1], param, simp) )
+                entries[i,j] = budget.guard(lambda: budget.spill( -(t1 + t2 + t3 + t4)/t5 ))
+                del t1, t2, t3, t4, t5
     else:
         for i in range(B):
             for j in range(i+1):
-                t1 = (  diff(a[0],q[i],q[j]) )#.ratsimp()
-                t2 = ( (diff(a[1],q[i])*c[j]) )#.ratsimp()
-                t3 = ( (diff(a[1],q[j])*c[i]) )#.ratsimp()
-                t4 = ( (2*a[2]*c[i]*c[j]) )#.ratsimp()
-                t5 = ( a[1] )#.ratsimp()
-                C[i,j] = -(t1 + t2 + t3 + t4)/t5
+                entries[i,j] = budget.guard(lambda: budget.spill( -(
+                        diff(a[0],q[i],q[j])        # t1
+                      + diff(a[1],q[i])*c[j]        # t2
+                      + diff(a[1],q[j])*c[i]        # t3
+                      + 2*a[2]*c[i]*c[j] )          # t4
+                      / a[1] ))                     # t5
+
+    ### the characteristic polynomial is not needed anymore
+    del a
 
     ### Populate Covariance Matrix
     
     ## If no simplification, perform parametrization now
     if(not doSimplify):
-        c = c.subs(param)
+        c = c.applyfunc(lambda e: budget.subs(e, param))
 
     ### simplification of the expectation should be safe to do, in any case
-    c = simplify(c)
+    budget.phase("simplifying expectation")
+    c = c.applyfunc(lambda e: budget.apply(simplify, e))
 
     ### simplification of covariance is possibly very time consuming
-    C = C.subs(param)
     if(doSimplify):
         print("--- %s seconds ---" % (time.time() - start_time))
         print("Start simplifying covariance matrix")
-        C = simplify(C)
-    
-    ### subsitute q=0 into covariance
-    for i in range(B):
-        C = C.subs(q[i],0)    
+    budget.phase("simplifying covariance matrix")
+    for (i,j) in entries:
+        entry = budget.subs(budget.guard(budget.load, entries[i,j]), param)
+        entries[i,j] = None
+        if(doSimplify):
+            entry = budget.apply(simplify, entry)
+        ### subsitute q=0 into covariance
+        C[i,j] = budget.subs(entry, [(q[k],0) for k in range(B)])
 
     
     print("--- %s seconds ---" % (time.time() - start_time))
@@ -212,7 +454,76 @@ def getCumulants(model, chords, param=[], simp=[], unsimp=[]):
             C[j,i] = C[i,j]
     
     ### return unsimplified expecation and covariance
-    return( [c.subs(unsimp),C.subs(unsimp)]) 
+    return( [c.applyfunc(lambda e: budget.subs(e, unsimp)),
+             C.applyfunc(lambda e: budget.subs(e, unsimp))] )
+
+
+#######################################
+# Cumulants of periodic models
+#######################################
+
+### Get the state space (as a set) from a given unit cell.
+### Keys may carry a label as third entry to distinguish parallel transitions.
+def getCellStateSpace(cell):
+    return(set(int(edge[i]) for edge in cell for i in (0,1)))
+
+# 'cell' describes the unit cell of a periodic model. It is a dictionary
+#        with keys == transitions (i,j) or (i,j,label) and values == rates.
+#        The optional label distinguishes parallel transitions between the
+#        same pair of states, e.g. a step with or without hydrolysis.
+#        Transitions (i,i) leave the state unchanged but may still count.
+# 'increments' maps each transition to a tuple with the increments of the
+#        observables, e.g. (step, ATP consumed). Missing transitions do
+#        not change any observable.
+# 'param', 'simp', 'unsimp' and 'budget' are as for getCumulants
+#
+# Returns the cumulants [c,C] of the observables, in the order given by the
+# increments, without the need for chords or an unrolled chain.
+
+def getPeriodicCumulants(cell, increments, param=[], simp=[], unsimp=[], budget=None):
+
+    start_time = time.time()
+
+    ### Check whether the state space is an integer range starting at 0
+    space = getCellStateSpace(cell)
+    if( space != set(range(len(space))) ):
+        print(" ERROR:  Given state space is not an "
+                    "integer range starting at 0.")
+        return( False )
+
+    ### Check whether increments refer to transitions of the unit cell
+    if( not set(increments.keys()).issubset(cell.keys()) ):
+        print(" ERROR:  Given increments are not contained in given unit cell.  ")
+        return( False )
+
+    ### Check whether all transitions count the same number of observables
+    dims = set(map(len,increments.values()))
+    if( len(dims) != 1 ):
+        print(" ERROR:  Given increments do not have a common length.  ")
+        return( False )
+
+    ### number of states
+    N = len(space)
+
+    ### number of observables
+    B = dims.pop()
+
+    q=zeros(B,1)
+    for i in range(B):
+        name = 'q_{{{0}}}'.format(i)
+        q[i] = symbols(name)
+
+    ### Generate tilted matrix, summing up parallel transitions
+    Wq = zeros(N)
+    for edge in cell:
+        i, j = int(edge[0]), int(edge[1])
+        d = increments.get(edge, (0,)*B)
+        Wq[i,j] += cell[edge]*exp(sum(d[k]*q[k] for k in range(B)))
+        Wq[i,i] -= cell[edge]
+
+    #display(Wq)
+
+    return( getTiltedCumulants(Wq, q, param, simp, unsimp, start_time, budget) )
 
 
 ##########################################################################
@@ -17,15 +17,12 @@ def lau():
 
     half = Rational(1,2)
 
-    # calculate SCGF
-    scgfLa = cumulants.getSCGF(TiltedWLa)
+    # calculate the cumulants of displacement and hydrolysis from the unit cell
+    cumsLa = cumulants.getPeriodicCumulants(modelLa, incrementsLa)
 
-    # and get the cumulants
-    cumDisLa = diff(scgfLa, l)
-    cumDisLa = half*cumDisLa.subs([(l,0),(g,0)]) # because velo is measured in d=L/2
+    cumDisLa = half*cumsLa[0][0] # because velo is measured in d=L/2
 
-    cumDisDisLa = diff(scgfLa, l, l) 
-    cumDisDisLa = (half**2)*cumDisDisLa.subs([(l,0),(g,0)]) #  because diffu is measured in d^2=(L/2)^2
+    cumDisDisLa = (half**2)*cumsLa[1][0,0] #  because diffu is measured in d^2=(L/2)^2
 
     respDisDisLa = 2*diff(cumDisLa,f)/cumDisDisLa  #  non-dimensionalized quantity, obtained by deriving the right nondim velocity with the correct non-dimensionalized force
 
@@ -39,12 +36,12 @@ def lau():
 #  Liepelt, Lipowsky PRL 98 (2007)       #
 ##########################################
 
-def ll(quick=True):
+def ll(quick=True, budget=None):
 
-    cums6_exact = cumulants.getCumulants(model6State,[(1,4),(3,4)], kinesin6_exact)
+    cums6_exact = cumulants.getPeriodicCumulants(model6State, increments6State, kinesin6_exact, budget=budget)
 
     vel6_exact = cums6_exact[0][0]
-    hyd6_exact = vel6_exact + 2 * cums6_exact[0][1]
+    hyd6_exact = cums6_exact[0][1]
     dif6_exact = .5 * cums6_exact[1][0,0]
 
 #    if (not quick):
@@ -69,12 +66,12 @@ def ll(quick=True):
 ##########################################
 
     if(quick):
-        cums4_exact = cumulants.getCumulants(model4State,[(0,2),(1,2)], kinesin4_exact)
+        cums4_exact = cumulants.getPeriodicCumulants(model4State, increments4State, kinesin4_exact, budget=budget)
     else:
-        cums4_exact = cumulants.getCumulants(model4State,[(0,2),(1,2)], kinesin4_exact, logargs, expargs) 
+        cums4_exact = cumulants.getPeriodicCumulants(model4State, increments4State, kinesin4_exact, logargs, expargs, budget) 
 
     vel4_exact = cums4_exact[0][0]
-    hyd4_exact = vel4_exact + 2 * cums4_exact[0][1]
+    hyd4_exact = cums4_exact[0][1]
     coupling4_exact = hyd4_exact/vel4_exact
 
     for thing in vel4_exact, hyd4_exact, coupling4_exact:
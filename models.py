@@ -54,6 +54,15 @@ model6State = {(0,1): w12, (1,0): w21,\
                (4,5): w56, (5,4): w65\
                }
 
+# Increments (step, ATP consumed) per transition of the 6 state model,
+# for use as a periodic model with cumulants.getPeriodicCumulants.
+# The mechanical step is 2->5, ATP binds in 1->2 and 4->5.
+
+increments6State = {(1,4): (1,0), (4,1): (-1,0),\
+                    (0,1): (0,1), (1,0): (0,-1),\
+                    (3,4): (0,1), (4,3): (0,-1)\
+                    }
+
 # A 4 state model already including the topology
 # for kinesin as described in Altaner+Vollmer2014.
 
@@ -65,6 +74,14 @@ model4State = {(0,1): w12, (1,0): w21,\
                (2,3): w34, (3,2): w43 \
                }
 
+# Increments (step, ATP consumed) per transition of the 4 state model.
+# The mechanical step is 1->3, ATP binds in 2->3 and 4->1.
+
+increments4State = {(0,2): (1,0), (2,0): (-1,0),\
+                    (1,2): (0,1), (2,1): (0,-1),\
+                    (3,0): (0,1), (0,3): (0,-1)\
+                    }
+
 ##########################################
 ## A numerical version of the kinesin4 model
 ##########################################
@@ -352,3 +369,21 @@ TiltedWLa = TiltedWLa.subs(f,-f/2)
 trace = TiltedWLa.trace()
 det = TiltedWLa.det()
 scgfLa = trace/2 + sqrt(trace**2/4-det) #positive sign give largest EV
+
+# The same model as a periodic unit cell with parallel transitions between
+# the states A (0) and B (1), labelled by the rates above. The increments are
+# (lambda, gamma), i.e. (displacement, hydrolysis) as counted in TiltedWLa.
+modelLa = {(0,1,'lAp'): wlAp, (0,1,'lAn'): wlAn,\
+           (0,1,'rAp'): wrAp, (0,1,'rAn'): wrAn,\
+           (1,0,'lBm'): wlBm, (1,0,'lBn'): wlBn,\
+           (1,0,'rBm'): wrBm, (1,0,'rBn'): wrBn\
+           }
+
+# Same conventions as for TiltedWLa
+modelLa = {edge: rate.subs(f,-f/2) for edge, rate in modelLa.items()}
+
+incrementsLa = {(0,1,'lAp'): (1,-1), (0,1,'lAn'): (1,0),\
+                (0,1,'rAp'): (-1,-1), (0,1,'rAn'): (-1,0),\
+                (1,0,'lBm'): (1,1), (1,0,'lBn'): (1,0),\
+                (1,0,'rBm'): (-1,1), (1,0,'rBn'): (-1,0)\
+                }
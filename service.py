@@ -0,0 +1,237 @@
+# Local evaluation service for the lambdified cumulants
+#
+# The symbolic calculation behind lambdification.lau() and lambdification.ll()
+# takes a long time. This module keeps the resulting evaluators warm in a
+# single long-running process, which serves many clients over a Unix socket
+# or a localhost TCP port:
+#
+#   python service.py --socket /tmp/cumulants.sock lau ll
+#
+#   import service
+#   res = service.evaluate('lau', f_values, mu_values, path='/tmp/cumulants.sock')
+#
+# Concurrent requests for the same model are coalesced into one vectorized
+# call of each evaluator.
+
+import asyncio
+import json
+import os
+import stat
+import struct
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from numpy import asarray, ascontiguousarray, broadcast_arrays, broadcast_to,\
+                  concatenate, empty, float64, frombuffer
+
+import lambdification
+
+#######################################
+# Registered models
+#######################################
+
+# 'models' maps a model name to a function returning a list of
+# evaluators, each taking numpy arrays (x, y) == (f, mu)
+models = {'lau': lambdification.lau,
+          'll':  lambdification.ll}
+
+### Wire format: every message is a JSON header, prefixed by its length
+### as an unsigned 32 bit integer, followed by raw float64 data.
+### Request header:  {"model": name, "n": n}, data: x[0..n), y[0..n)
+### Response header: {"m": m, "n": n} or {"error": message}, data: m rows of n values
+
+def packHeader(header):
+    raw = json.dumps(header).encode()
+    return(struct.pack('!I', len(raw)) + raw)
+
+
+#######################################
+# Request coalescing
+#######################################
+
+# Collect concurrent requests for one model and evaluate them at once.
+# Requests arriving within 'window' seconds of the first pending request
+# are concatenated into a single array and passed to every evaluator in
+# one call. Each request then receives its slice of the result.
+
+class Coalescer:
+
+    def __init__(self, evaluators, executor, window=0.002):
+        self.evaluators = evaluators
+        self.executor = executor
+        self.window = window
+        self.pending = []
+        self.tasks = set() # keep running batches from being garbage-collected
+
+    def schedule(self):
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def evaluate(self, x, y):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((x, y, future))
+        ### the first pending request schedules the batch
+        if( len(self.pending) == 1 ):
+            loop.call_later(self.window, self.schedule)
+        return(await future)
+
+    def evaluateBatch(self, x, y):
+        res = empty((len(self.evaluators), len(x)), dtype=float64)
+        for i, evaluator in enumerate(self.evaluators):
+            ### constant expressions are lambdified to scalars
+            res[i] = broadcast_to(evaluator(x, y), x.shape)
+        return(res)
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        x = concatenate([item[0] for item in batch])
+        y = concatenate([item[1] for item in batch])
+        loop = asyncio.get_running_loop()
+        try:
+            res = await loop.run_in_executor(self.executor, self.evaluateBatch, x, y)
+        except Exception as err:
+            for item in batch:
+                ### a waiting handler may have been cancelled meanwhile
+                if( not item[2].done() ):
+                    item[2].set_exception(err)
+            return
+        start = 0
+        for item in batch:
+            n = len(item[0])
+            if( not item[2].done() ):
+                item[2].set_result(res[:, start:start+n])
+            start += n
+
+
+#######################################
+# Server
+#######################################
+
+# Load the evaluators of the given models once and serve them
+
+class Service:
+
+    def __init__(self, names, window=0.002):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.coalescers = {}
+        for name in names:
+            start_time = time.time()
+            print("Loading model %s" % name)
+            self.coalescers[name] = Coalescer(models[name](), self.executor, window)
+            print("--- %s seconds ---" % (time.time() - start_time))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    size = struct.unpack('!I', await reader.readexactly(4))[0]
+                except asyncio.IncompleteReadError:
+                    break
+                try:
+                    header = json.loads(await reader.readexactly(size))
+                    name, n = header['model'], int(header['n'])
+                    data = frombuffer(await reader.readexactly(16*n), dtype=float64)
+                except (asyncio.IncompleteReadError, ValueError, KeyError, TypeError) as err:
+                    ### the stream cannot be resynchronized after a bad request
+                    writer.write(packHeader({'error': "Bad request: %r" % err}))
+                    await writer.drain()
+                    break
+                if( name not in self.coalescers ):
+                    writer.write(packHeader({'error': "Unknown model %s" % name}))
+                    await writer.drain()
+                    continue
+                ### nothing to evaluate for an empty request
+                if( n == 0 ):
+                    writer.write(packHeader({'m': len(self.coalescers[name].evaluators), 'n': 0}))
+                    await writer.drain()
+                    continue
+                try:
+                    res = await self.coalescers[name].evaluate(data[:n], data[n:])
+                except Exception as err:
+                    writer.write(packHeader({'error': repr(err)}))
+                    await writer.drain()
+                    continue
+                writer.write(packHeader({'m': res.shape[0], 'n': n}))
+                if( res.size > 0 ): # memoryview cannot cast empty arrays
+                    writer.write(memoryview(ascontiguousarray(res)).cast('B'))
+                await writer.drain()
+        except ConnectionError:
+            pass # client went away
+        finally:
+            writer.close()
+
+    async def serve(self, path=None, host='127.0.0.1', port=8765):
+        if( path is not None ):
+            ### remove the socket left over by a previous run
+            if( os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode) ):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+        print("Serving models %s" % ", ".join(self.coalescers))
+        async with server:
+            await server.serve_forever()
+
+
+#######################################
+# Client
+#######################################
+
+def recvexactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while size > 0:
+        nbytes = sock.recv_into(view, size)
+        if( nbytes == 0 ):
+            raise ConnectionError("Connection closed by the service")
+        view = view[nbytes:]
+        size -= nbytes
+    return(buf)
+
+# 'name' is a registered model
+# 'x', 'y' are the parameters (f, mu), scalars or arrays broadcastable to a common shape
+# 'path' is the Unix socket of the service, otherwise 'host' and 'port' are used
+#
+# Returns an array of shape (number of evaluators, ) + shape of x and y,
+# which is a view on the received buffer.
+
+def evaluate(name, x, y, path=None, host='127.0.0.1', port=8765):
+    x, y = broadcast_arrays(asarray(x, dtype=float64), asarray(y, dtype=float64))
+    shape = x.shape
+    x, y = [ascontiguousarray(v).ravel() for v in (x, y)]
+
+    if( path is not None ):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    else:
+        sock = socket.create_connection((host, port))
+
+    with sock:
+        sock.sendall(packHeader({'model': name, 'n': len(x)}))
+        sock.sendall(x)
+        sock.sendall(y)
+        size = struct.unpack('!I', recvexactly(sock, 4))[0]
+        header = json.loads(recvexactly(sock, size))
+        if( 'error' in header ):
+            raise RuntimeError(header['error'])
+        data = recvexactly(sock, 8*header['m']*header['n'])
+
+    return(frombuffer(data, dtype=float64).reshape((header['m'],) + shape))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve lambdified cumulants.")
+    parser.add_argument('models', nargs='*', default=list(models), choices=list(models))
+    parser.add_argument('--socket', dest='path', default=None, help="Unix socket path")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--window', type=float, default=0.002,
+                        help="coalescing window in seconds")
+    args = parser.parse_args()
+
+    asyncio.run(Service(args.models, args.window).serve(args.path, args.host, args.port))